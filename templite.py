@@ -6,6 +6,9 @@
 
 import re
 import os
+import threading
+import time
+from concurrent.futures import wait
 
 
 class TempliteSyntaxError(ValueError):
@@ -71,16 +74,151 @@ class CodeBuilder(object):
         return global_namespace
 
 
+class TempliteMetrics(object):
+    """
+    编译和渲染的统计, 按模板名保存在内存中, 可以导出为Prometheus文本格式
+
+    同一个对象可以被多个模板和多个线程共享. 抛出异常的渲染不计入耗时和
+    输出大小的直方图, 只计入templite_render_errors_total计数器
+    """
+
+    # 直方图的桶, 耗时单位为秒, 输出大小单位为字符
+    SECONDS_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+    SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+    # 指标名: (帮助信息, 桶)
+    HISTOGRAMS = {
+        "templite_compile_seconds": ("Time spent compiling templates.", SECONDS_BUCKETS),
+        "templite_render_seconds": ("Time spent rendering templates.", SECONDS_BUCKETS),
+        "templite_render_output_chars": ("Size of rendered output in characters.", SIZE_BUCKETS),
+    }
+
+    # 指标名: 帮助信息
+    COUNTERS = {
+        "templite_render_errors_total": "Renders that raised an exception.",
+    }
+
+    def __init__(self):
+        """构造函数"""
+        self._lock = threading.Lock()
+        # 指标名 -> 模板名 -> [每个桶的计数, 总和, 总数]
+        self._histograms = dict((metric, {}) for metric in self.HISTOGRAMS)
+        # 指标名 -> 模板名 -> 计数
+        self._counters = dict((metric, {}) for metric in self.COUNTERS)
+
+    def observe_compile(self, name, seconds):
+        """
+        记录一次编译
+        """
+        self._observe("templite_compile_seconds", name, seconds)
+
+    def observe_render(self, name, seconds, size):
+        """
+        记录一次渲染
+        """
+        self._observe("templite_render_seconds", name, seconds)
+        self._observe("templite_render_output_chars", name, size)
+
+    def observe_render_error(self, name):
+        """
+        记录一次抛出异常的渲染
+        """
+        name = str(name)
+        with self._lock:
+            errors = self._counters["templite_render_errors_total"]
+            errors[name] = errors.get(name, 0) + 1
+
+    def _observe(self, metric, name, value):
+        """
+        把一个值记录到直方图中
+        """
+        name = str(name)
+        buckets = self.HISTOGRAMS[metric][1]
+        with self._lock:
+            series = self._histograms[metric].get(name)
+            if series is None:
+                series = self._histograms[metric][name] = [[0] * len(buckets), 0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self):
+        """
+        返回当前统计的副本
+        直方图的格式为 {指标名: {模板名: {"buckets": [(上界, 累计个数), ...], "sum": 总和, "count": 总数}}}
+        计数器的格式为 {指标名: {模板名: 计数}}
+        """
+        result = {}
+        with self._lock:
+            for metric, by_name in self._histograms.items():
+                buckets = self.HISTOGRAMS[metric][1]
+                result[metric] = dict(
+                    (name, {
+                        "buckets": list(zip(buckets, counts)),
+                        "sum": total,
+                        "count": count,
+                    })
+                    for name, (counts, total, count) in by_name.items()
+                )
+            for metric, by_name in self._counters.items():
+                result[metric] = dict(by_name)
+        return result
+
+    def export(self):
+        """
+        导出为Prometheus文本格式
+        """
+        lines = []
+        for metric, by_name in sorted(self.snapshot().items()):
+            if metric in self.COUNTERS:
+                lines.append("# HELP %s %s" % (metric, self.COUNTERS[metric]))
+                lines.append("# TYPE %s counter" % metric)
+                for name, count in sorted(by_name.items()):
+                    lines.append('%s{template="%s"} %d' % (metric, self._escape(name), count))
+                continue
+
+            lines.append("# HELP %s %s" % (metric, self.HISTOGRAMS[metric][0]))
+            lines.append("# TYPE %s histogram" % metric)
+            for name, series in sorted(by_name.items()):
+                label = 'template="%s"' % self._escape(name)
+                for bound, count in series["buckets"]:
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (metric, label, bound, count))
+                lines.append('%s_bucket{%s,le="+Inf"} %d' % (metric, label, series["count"]))
+                lines.append("%s_sum{%s} %s" % (metric, label, series["sum"]))
+                lines.append("%s_count{%s} %d" % (metric, label, series["count"]))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _escape(value):
+        """
+        转义标签值中的反斜杠, 双引号和换行符
+        """
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
 class Templite(object):
-    """模板渲染的类, 符合Django的模板语法"""
+    """模板渲染的类, 符合Django的模板语法
 
-    def __init__(self, text, *contexts):
+    编译完成后的对象是可重入的: 编译期的状态只在构造函数中修改, 渲染时
+    只读取这些状态, 每次渲染都使用新的上下文字典, 所以同一个对象可以在
+    多个线程中同时调用render.
+    """
+
+    def __init__(self, text, *contexts, name="<template>", metrics=None):
         """构造函数
 
         :text: 全文
         :*contexts: 上下文
+        :name: 模板名, 用于统计
+        :metrics: 可选的TempliteMetrics对象, 提供时记录编译和渲染的统计
 
         """
+        start = time.perf_counter()
+
+        self.name = name
+        self.metrics = metrics
         self.context = {}  # 这里保存的默认的上下文键值对
         for context in contexts:
             self.context.update(context)
@@ -88,32 +226,6 @@ class Templite(object):
         self.all_vars = set()  # 这是全局变量, 是模板中所有的变量的集合
         self.loop_vars = set()  # 这是循环中的变量, 是循环体中变量, 所以并不是由上下文所提供
 
-        code = CodeBuilder()  # 类的对象
-
-        # 这里增加的代码是初始代码
-        code.add_line("def render_function(context, do_dots):")
-        code.indent()  # 增加缩进
-        vars_code = code.add_section()  # 增加一段
-        code.add_line("result = []")  # 增加一个list变量
-        code.add_line("append_result = result.append")  # 增加append函数
-        code.add_line("extend_result = result.extend")  # 增加extent函数
-        code.add_line("to_str = str")  # 增加str变量
-
-        buffered = []  # 缓冲
-
-        def flush_output():
-            """
-            缓冲输出, 缓冲内容为一行就调用append_result函数
-            超过一行就调用extend_result函数
-            """
-            if len(buffered) == 1:
-                code.add_line("append_result(%s)" % buffered[0])
-            elif len(buffered) > 1:
-                code.add_line("extend_result([%s])" % ", ".join(buffered))
-            del buffered[:]
-
-        ops_stack = []
-
         tokens = re.split(r"(?s)({{.*?}}|{%.*?%}|{#.*?#})", text)
 
         if tokens[1].startswith("{%"):  # 从这里开始就是为了处理模板的继承
@@ -165,6 +277,7 @@ class Templite(object):
                             except KeyError:
                                 raise self._syntax_error("Don't find block", kid_token)
                             merge_page.extend(base_tokens[end_index:start_index])
+                            merge_page.append(kid_token)
                             end_index = _i + 1
                             start_collection = True
                             continue
@@ -172,6 +285,7 @@ class Templite(object):
                         elif words[0] == "endblock":
                             if len(words) != 1 or not start_collection:
                                 raise self._syntax_error("Don't understand endblock", kid_token)
+                            merge_page.append(kid_token)
                             start_collection = False
                             continue
 
@@ -181,10 +295,10 @@ class Templite(object):
                         if word == "super()":
                             if not start_collection:
                                 raise self._syntax_error("Error super()", kid_token)
-                            merge_page.extend(base_tokens[start_index:end_index - 1])
+                            merge_page.extend(base_tokens[start_index + 1:end_index - 1])
                             continue
 
-                    elif start_collection:
+                    if start_collection:
                         merge_page.append(kid_token)
                     elif kid_token.strip():
                         raise self._syntax_error("The model codes aren't in block", kid_token)
@@ -192,13 +306,90 @@ class Templite(object):
                 merge_page.extend(base_tokens[end_index:])
                 tokens = merge_page
 
+        # 串行渲染使用和原来一样的平铺的函数, 块不单独生成函数
+        self._render_function, scopes = self._compile(tokens, False)
+
+        # 只有在并行渲染和串行渲染结果一致时才生成并行渲染的函数, 否则
+        # 提供执行器时也串行渲染
+        self._parallel_render_function = None
+        if len(scopes) > 1 and self._parallel_safe(scopes):
+            self._parallel_render_function = self._compile(tokens, True)[0]
+
+        if metrics is not None:
+            metrics.observe_compile(name, time.perf_counter() - start)
+
+    def _compile(self, tokens, parallel):
+        """
+        把模板编译成python函数
+        参数:
+            :tokens: 模板切分后的片段
+            :parallel: 为真时每个顶层块生成单独的函数, 渲染函数返回片段的列表,
+                块的结果通过submit得到; 否则生成平铺的函数, 直接返回渲染结果
+        返回渲染函数和每个作用域中读取和绑定的变量
+        """
+        code = CodeBuilder()  # 类的对象
+
+        # 这里增加的代码是初始代码
+        if parallel:
+            code.add_line("def render_function(context, do_dots, submit):")
+        else:
+            code.add_line("def render_function(context, do_dots):")
+        code.indent()  # 增加缩进
+        vars_code = code.add_section()  # 增加一段
+        code.add_line("result = []")  # 增加一个list变量
+        code.add_line("append_result = result.append")  # 增加append函数
+        code.add_line("extend_result = result.extend")  # 增加extent函数
+        code.add_line("to_str = str")  # 增加str变量
+
+        buffered = []  # 缓冲
+
+        def flush_output():
+            """
+            缓冲输出, 缓冲内容为一行就调用append_result函数
+            超过一行就调用extend_result函数
+            """
+            if len(buffered) == 1:
+                code.add_line("append_result(%s)" % buffered[0])
+            elif len(buffered) > 1:
+                code.add_line("extend_result([%s])" % ", ".join(buffered))
+            del buffered[:]
+
+        ops_stack = []
+        loop_stack = []  # 每一层循环中的循环变量
+
+        # scopes: 每个作用域中的变量, 第一个是render_function, 其余是顶层块
+        # reads: 作用域中读取的, 不是由外层循环在当前作用域中绑定的变量
+        # writes: 作用域中的循环变量
+        scopes = [{"reads": set(), "writes": set()}]
+        scope = scopes[0]
+
+        def expr_code(expr):
+            """
+            生成python表达式, 并记录读取的变量
+            """
+            code = self._expr_code(expr)
+            bound = set().union(*loop_stack)
+            for var_name in re.findall(r"(?<!['\w])c_(\w+)", code):
+                if var_name not in bound:
+                    scope["reads"].add(var_name)
+            return code
+
+        # block_count: 顶层块的个数, 用来给块函数命名
+        # block_header: 块函数的定义, 读取的变量都确定后再生成
+        # in_block: 当前是否在顶层块中
+        # nested_blocks: 嵌套在逻辑语句或其他块中的块, 这些块不单独生成函数
+        block_count = 0
+        block_header = None
+        in_block = False
+        nested_blocks = 0
+
         for token in tokens:
             if token.startswith('{#'):
                 # 注释: 忽略注释符中的内容
                 continue
             elif token.startswith('{{'):
                 # 替换上下文的变量
-                expr = self._expr_code(token[2:-2].strip())
+                expr = expr_code(token[2:-2].strip())
                 buffered.append("to_str(%s)" % expr)
             elif token.startswith('{%'):
                 # 这里是简单的逻辑部分
@@ -212,7 +403,7 @@ class Templite(object):
                     _content = []
                     for word in words[1:]:
                         if re.match(r"[_a-zA-Z][_a-zA-Z0-9]*(\.[_a-zA-Z][_a-zA-Z0-9]*)*$", word):
-                            _content.append(self._expr_code(word))
+                            _content.append(expr_code(word))
                             continue
                         _content.append(word)
 
@@ -225,34 +416,39 @@ class Templite(object):
                     ops_stack.append('for')
 
                     if len(words) == 4:
+                        loop_names = [words[1]]
                         self._variable(words[1], self.loop_vars)
                         code.add_line(
                             "for c_%s in %s:" % (
                                 words[1],
-                                self._expr_code(words[3])
+                                expr_code(words[3])
                             )
                         )
                     elif len(words) == 5:
+                        loop_names = [words[1].replace(",", ""), words[2].replace(",", "")]
                         self._variable(words[1].replace(",", ""), self.loop_vars)
                         self._variable(words[2].replace(",", ""), self.loop_vars)
                         code.add_line(
                             "for c_%s , c_%s in %s:" % (
                                 words[1].replace(",", ""),
                                 words[2].replace(",", ""),
-                                self._expr_code(words[4])
+                                expr_code(words[4])
                             )
                         )
                     elif len(words) == 6:
+                        loop_names = [words[1], words[3]]
                         self._variable(words[1], self.loop_vars)
                         self._variable(words[3], self.loop_vars)
                         code.add_line(
                             "for c_%s , c_%s in %s:" % (
                                 words[1],
                                 words[2],
-                                self._expr_code(words[4])
+                                expr_code(words[4])
                             )
                         )
 
+                    scope["writes"].update(loop_names)
+                    loop_stack.append(set(loop_names))
                     code.indent()
                 elif words[0].startswith('end'):
                     # 结束符, 用来结束逻辑语句
@@ -261,6 +457,27 @@ class Templite(object):
                     end_what = words[0][3:]
 
                     if end_what == "block":
+                        if nested_blocks:
+                            nested_blocks -= 1
+                        elif in_block:
+                            # 顶层块结束, 块函数返回自己的渲染结果
+                            if ops_stack:
+                                self._syntax_error("Unmatched action tag", ops_stack[-1])
+                            if parallel:
+                                # 块读取的外部变量作为默认参数, 在定义块函数时取值,
+                                # 和串行渲染时读到的值一致
+                                block_header.add_line("def block_%d(%s):" % (
+                                    block_count,
+                                    ", ".join(
+                                        "c_%s=c_%s" % (var_name, var_name)
+                                        for var_name in sorted(scope["reads"] - scope["writes"])
+                                    )
+                                ))
+                                code.add_line("return ''.join(result)")
+                                code.dedent()
+                                code.add_line("append_result(submit(block_%d))" % block_count)
+                            scope = scopes[0]
+                            in_block = False
                         continue
 
                     if not ops_stack:
@@ -274,6 +491,8 @@ class Templite(object):
 
                     if start_what != end_what:
                         self._syntax_error("Mismatched end tag", end_what)
+                    if start_what == "for":
+                        loop_stack.pop()
                     code.dedent()
 
                 elif words[0] == "else":
@@ -294,14 +513,31 @@ class Templite(object):
                     _content = []
                     for word in words[1:]:
                         if re.match(r"[_a-zA-Z][_a-zA-Z0-9]*(\.[_a-zA-Z][_a-zA-Z0-9]*)*$", word):
-                            _content.append(self._expr_code(word))
+                            _content.append(expr_code(word))
                             continue
                         _content.append(word)
 
                     code.add_line("elif %s:" % ' '.join(_content))
                     code.indent()
 
-                elif words[0] == "block" or words[0] == "extends":
+                elif words[0] == "block":
+                    # 并行渲染时每个顶层块编译成一个单独的函数, 通过submit
+                    # 执行, 可以交给线程池并行渲染; 串行渲染时块直接展开
+                    if in_block or ops_stack:
+                        nested_blocks += 1
+                        continue
+                    block_count += 1
+                    in_block = True
+                    scope = {"reads": set(), "writes": set()}
+                    scopes.append(scope)
+                    if parallel:
+                        block_header = code.add_section()
+                        code.indent()
+                        code.add_line("result = []")
+                        code.add_line("append_result = result.append")
+                        code.add_line("extend_result = result.extend")
+
+                elif words[0] == "extends":
                     continue
                 else:
                     self._syntax_error("Don't understand tag", words[0])
@@ -311,6 +547,8 @@ class Templite(object):
                     buffered.append(repr(token))
         if ops_stack:
             self._syntax_error("Unmatched action tag", ops_stack[-1])
+        if in_block:
+            self._syntax_error("Unmatched action tag", "block")
 
         flush_output()
 
@@ -318,9 +556,27 @@ class Templite(object):
         for var_name in self.all_vars - self.loop_vars:
             vars_code.add_line("c_%s = context[%r]" % (var_name, var_name))
 
-        code.add_line("return ''.join(result)")
+        if parallel:
+            code.add_line("return result")
+        else:
+            code.add_line("return ''.join(result)")
         code.dedent()
-        self._render_function = code.get_globals()['render_function']
+        return code.get_globals()['render_function'], scopes
+
+    @staticmethod
+    def _parallel_safe(scopes):
+        """
+        判断顶层块能否并行渲染
+        块中的循环变量在串行渲染时会影响块外面读取到的值, 所以一个块的循环
+        变量不能被其他作用域读取; 块读取的自己也绑定的变量, 不能被其他作用域绑定
+        """
+        for i, scope in enumerate(scopes[1:], 1):
+            for other in scopes[:i] + scopes[i + 1:]:
+                if scope["writes"] & other["reads"]:
+                    return False
+                if scope["writes"] & scope["reads"] & other["writes"]:
+                    return False
+        return True
 
     def _expr_code(self, expr):
         """
@@ -353,14 +609,60 @@ class Templite(object):
             self._syntax_error("Not a valid name", name)
         vars_set.add(name)
 
-    def render(self, context=None):
+    def render(self, context=None, executor=None):
         """
         渲染函数
+        参数:
+            :context: 渲染时的上下文, 会覆盖构造时提供的上下文
+            :executor: 可选的执行器(如concurrent.futures.ThreadPoolExecutor),
+                提供时顶层的块会提交到执行器中并行渲染, 再按原来的顺序拼接.
+                注意执行器不能是正在执行render的线程池, 否则render会占住工作线程
+                等待块的结果, 工作线程不够时会死锁
         """
         render_context = dict(self.context)
         if context:
             render_context.update(context)
-        return self._render_function(render_context, self._do_dots)
+        if self.metrics is None:
+            if executor is None:
+                return self._render_function(render_context, self._do_dots)
+            return self._render(render_context, executor)
+
+        # 开启统计时记录耗时和输出大小, 抛出异常的渲染只计数
+        start = time.perf_counter()
+        try:
+            output = self._render(render_context, executor)
+        except Exception:
+            self.metrics.observe_render_error(self.name)
+            raise
+        self.metrics.observe_render(self.name, time.perf_counter() - start, len(output))
+        return output
+
+    def _render(self, render_context, executor):
+        """
+        用合并后的上下文渲染模板, 返回渲染结果
+        """
+        if executor is None or self._parallel_render_function is None:
+            return self._render_function(render_context, self._do_dots)
+
+        futures = []
+
+        def submit(block):
+            """
+            把块提交到执行器中, 记录下来以便出错时取消
+            """
+            future = executor.submit(block)
+            futures.append(future)
+            return future
+
+        try:
+            parts = self._parallel_render_function(render_context, self._do_dots, submit)
+            return ''.join(part if isinstance(part, str) else part.result() for part in parts)
+        except BaseException:
+            # 出错时取消还没开始的块, 并等待正在渲染的块结束
+            for future in futures:
+                future.cancel()
+            wait(futures)
+            raise
 
     def _do_dots(self, value, *dots):
         """
@@ -1,7 +1,12 @@
 """Tests for templite."""
 
+import os
 import re
-from templite import Templite, TempliteSyntaxError
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from templite import Templite, TempliteMetrics, TempliteSyntaxError
 from unittest import TestCase
 
 # pylint: disable=W0612,E1101
@@ -269,4 +274,259 @@ class TempliteTest(TestCase):
         with self.assertSynErr("Don't understand end: '{% end if %}'"):
             self.try_render("{% if x %}X{% end if %}")
         with self.assertSynErr("Don't understand end: '{% endif now %}'"):
-            self.try_render("{% if x %}X{% endif now %}")
\ No newline at end of file
+            self.try_render("{% if x %}X{% endif now %}")
+
+    def test_blocks(self):
+        # Blocks render in place, with or without an executor.
+        text = (
+            "<{% block a %}{{x}}{% endblock %}|"
+            "{% block b %}{% for n in nums %}{{n}}{% endfor %}{% endblock %}>"
+            )
+        data = {'x': 'X', 'nums': [1, 2, 3]}
+        self.try_render(text, data, "<X|123>")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            self.assertEqual(Templite(text).render(data, executor), "<X|123>")
+
+    def test_nested_blocks(self):
+        # Blocks inside loops or other blocks are rendered inline.
+        self.try_render(
+            "{% block a %}[{% block b %}{{x}}{% endblock %}]{% endblock %}"
+            "{% for n in nums %}{% block c %}{{n}}{% endblock %}{% endfor %}",
+            {'x': 'X', 'nums': [1, 2]},
+            "[X]12"
+            )
+
+    def test_parallel_blocks(self):
+        # Top-level blocks run concurrently on the executor, and the
+        # results are stitched together in template order.
+        barrier = threading.Barrier(2, timeout=5)
+
+        class Lazy(AnyOldObject):
+            """An object whose attribute access waits for the other block."""
+            def value(self):
+                """Return .txt once both blocks are running."""
+                barrier.wait()
+                return self.txt
+
+        template = Templite(
+            "{% block a %}{{a.value}}{% endblock %}-"
+            "{% block b %}{{b.value}}{% endblock %}"
+            )
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            actual = template.render(
+                {'a': Lazy(txt="A"), 'b': Lazy(txt="B")}, executor
+                )
+        self.assertEqual(actual, "A-B")
+
+    def test_parallel_blocks_see_serial_values(self):
+        # A block on the executor sees the values the variables had when
+        # the block was reached, not what the main thread set later.
+        done = threading.Event()
+
+        class Slow(AnyOldObject):
+            """An object whose attribute access waits for the main thread."""
+            def value(self):
+                """Return .txt once the template has been walked."""
+                done.wait(5)
+                return self.txt
+
+        class Signalling(object):
+            """An iterable that sets `done` once it has been iterated."""
+            def __iter__(self):
+                for n in [7, 8, 9]:
+                    yield n
+                done.set()
+
+        template = Templite(
+            "{% for x in xs %}.{% endfor %}"
+            "{% block a %}{{s.value}}{{x}}{% endblock %}"
+            "{% for x in ys %}.{% endfor %}"
+            )
+        data = {'xs': [1, 2], 'ys': Signalling(), 's': Slow(txt="s")}
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            self.assertEqual(template.render(data, executor), "..s2...")
+        self.assertEqual(template.render(data), "..s2...")
+
+    def test_block_loop_variable_after_block(self):
+        # Loop variables bound inside a block are still visible after it,
+        # with or without an executor.
+        template = Templite(
+            "{% block a %}{% for n in nums %}.{% endfor %}{% endblock %}{{n}}"
+            )
+        self.assertEqual(template.render({'nums': [1, 2, 3]}), "...3")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            self.assertEqual(template.render({'nums': [1, 2, 3]}, executor), "...3")
+
+    def test_parallel_block_error(self):
+        # When one block raises, render waits for the blocks still running
+        # before re-raising.
+        started = threading.Event()
+        finished = []
+
+        class Failing(AnyOldObject):
+            """An object whose attribute access raises."""
+            def value(self):
+                """Raise once the other block is running."""
+                started.wait(5)
+                raise ValueError("boom")
+
+        class Slow(AnyOldObject):
+            """An object whose attribute access takes a while."""
+            def value(self):
+                """Return .txt after a short sleep."""
+                started.set()
+                time.sleep(0.2)
+                finished.append(self.txt)
+                return self.txt
+
+        template = Templite(
+            "{% block a %}{{a.value}}{% endblock %}"
+            "{% block b %}{{b.value}}{% endblock %}"
+            )
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            with self.assertRaises(ValueError):
+                template.render({'a': Failing(), 'b': Slow(txt="B")}, executor)
+            self.assertEqual(finished, ["B"])
+
+    def test_reentrant_render(self):
+        # One Templite can be rendered from several threads at once, and
+        # each render only sees its own context.
+        barrier = threading.Barrier(3, timeout=5)
+
+        class Lazy(AnyOldObject):
+            """An object whose attribute access waits for the other renders."""
+            def value(self):
+                """Return .txt once all renders are running."""
+                barrier.wait()
+                return self.txt
+
+        template = Templite("<{{x.value}}{{name}}>", {'name': '?'})
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [
+                executor.submit(template.render, {'x': Lazy(txt=str(i)), 'name': i})
+                for i in range(3)
+                ]
+            actual = [future.result() for future in futures]
+        self.assertEqual(actual, ["<00>", "<11>", "<22>"])
+
+    def test_unmatched_block(self):
+        with self.assertSynErr("Unmatched action tag: 'block'"):
+            self.try_render("{% block a %}X")
+        with self.assertSynErr("Unmatched action tag: 'if'"):
+            self.try_render("{% block a %}{% if x %}X{% endblock %}{% endif %}")
+
+    def test_metrics(self):
+        # Compiles and renders are recorded per template name.
+        metrics = TempliteMetrics()
+        template = Templite("Hello, {{name}}!", name="hello", metrics=metrics)
+        Templite("Bye, {{name}}", name="bye", metrics=metrics)
+        self.assertEqual(template.render({'name': 'Ned'}), "Hello, Ned!")
+        self.assertEqual(template.render({'name': 'Ben'}), "Hello, Ben!")
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["templite_compile_seconds"]["hello"]["count"], 1)
+        self.assertEqual(snapshot["templite_compile_seconds"]["bye"]["count"], 1)
+        self.assertEqual(snapshot["templite_render_seconds"]["hello"]["count"], 2)
+        self.assertNotIn("bye", snapshot["templite_render_seconds"])
+        size = snapshot["templite_render_output_chars"]["hello"]
+        self.assertEqual(size["sum"], 22)
+        self.assertEqual(size["buckets"][0], (256, 2))
+
+    def test_metrics_export(self):
+        metrics = TempliteMetrics()
+        Templite("{{x}}", name='a"b', metrics=metrics).render({'x': 'xyz'})
+        text = metrics.export()
+        self.assertIn("# TYPE templite_render_seconds histogram\n", text)
+        self.assertIn('templite_render_output_chars_bucket{template="a\\"b",le="256"} 1\n', text)
+        self.assertIn('templite_render_output_chars_bucket{template="a\\"b",le="+Inf"} 1\n', text)
+        self.assertIn('templite_render_output_chars_sum{template="a\\"b"} 3\n', text)
+        self.assertIn('templite_compile_seconds_count{template="a\\"b"} 1\n', text)
+
+    def test_metrics_subclass(self):
+        # Metrics keep a subclass's render override in effect.
+        class Prefixed(Templite):
+            """A Templite that prefixes its output."""
+            def render(self, context=None, executor=None):
+                return "sub:" + super(Prefixed, self).render(context, executor)
+
+        metrics = TempliteMetrics()
+        template = Prefixed("hi {{x}}", name="sub", metrics=metrics)
+        self.assertEqual(template.render({'x': 1}), "sub:hi 1")
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["templite_render_seconds"]["sub"]["count"], 1)
+
+    def test_metrics_name_not_string(self):
+        # Names are recorded as strings, so export never breaks.
+        metrics = TempliteMetrics()
+        Templite("{{x}}", name=None, metrics=metrics).render({'x': 1})
+        self.assertIn('templite_render_seconds_count{template="None"} 1\n', metrics.export())
+
+    def test_metrics_render_error(self):
+        # Failed renders are counted, but not in the histograms.
+        metrics = TempliteMetrics()
+        template = Templite("{{x.y}}", name="bad", metrics=metrics)
+        with self.assertRaises(TypeError):
+            template.render({'x': None})
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["templite_render_errors_total"], {"bad": 1})
+        self.assertNotIn("bad", snapshot["templite_render_seconds"])
+        text = metrics.export()
+        self.assertIn("# TYPE templite_render_errors_total counter\n", text)
+        self.assertIn('templite_render_errors_total{template="bad"} 1\n', text)
+
+
+class TempliteExtendsTest(TestCase):
+    """Tests for template inheritance with {% extends %}."""
+
+    BASE = (
+        "<title>{% block title %}Base{% endblock %}</title>"
+        "<body>{% block body %}Body{% endblock %}</body>"
+        )
+
+    def setUp(self):
+        # Base templates are loaded from the template/ directory under the
+        # current directory.
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        os.mkdir(os.path.join(tmpdir.name, "template"))
+        with open(os.path.join(tmpdir.name, "template", "base.html"), "w") as fout:
+            fout.write(self.BASE)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tmpdir.name)
+
+    def test_super(self):
+        template = Templite(
+            '{% extends "base.html" %}'
+            "{% block title %}{{super()}} - Child{% endblock %}"
+            )
+        self.assertEqual(
+            template.render(),
+            "<title>Base - Child</title><body>Body</body>"
+            )
+
+    def test_variables_in_block(self):
+        template = Templite(
+            '{% extends "base.html" %}'
+            "{% block body %}Hello, {{name}}!{% endblock %}"
+            )
+        self.assertEqual(
+            template.render({'name': 'Ned'}),
+            "<title>Base</title><body>Hello, Ned!</body>"
+            )
+
+    def test_blocks_with_executor(self):
+        # An overridden block and an inherited base block both render in
+        # order on the executor.
+        template = Templite(
+            '{% extends "base.html" %}'
+            "{% block title %}{{title}}{% endblock %}"
+            )
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            actual = template.render({'title': 'Child'}, executor)
+        self.assertEqual(actual, "<title>Child</title><body>Body</body>")
+
+    def test_code_outside_block(self):
+        with self.assertRaisesRegex(
+                TempliteSyntaxError,
+                "^" + re.escape("The model codes aren't in block: '{{name}}'") + "$"):
+            Templite('{% extends "base.html" %}{{name}}')